@@ -1,34 +1,44 @@
 import os
+from functools import lru_cache
 from pathlib import Path
-from dotenv import load_dotenv
+from dotenv import dotenv_values
 
-# Load environment variables from .env file
-load_dotenv()
+# Parse the .env file once and overlay the process environment on top of it
+_ENV = {
+    **{k: v for k, v in dotenv_values(Path(__file__).parent / ".env").items() if v is not None},
+    **os.environ,
+}
 
 
 class Settings:
     """Application settings"""
 
     def __init__(self):
+        env = _ENV
+
         # GLM 4.7 API Configuration
-        self.glm_api_key = os.getenv("GLM_API_KEY", "6f8730568f884cb2b3626ad06224c493.tjzNgDr8p0HfP4Tt")
-        self.glm_api_base = os.getenv("GLM_API_BASE", "https://open.bigmodel.cn/api/paas/v4/")
-        self.glm_model = os.getenv("GLM_MODEL", "glm-4.7")
+        self.glm_api_key = env.get("GLM_API_KEY", "6f8730568f884cb2b3626ad06224c493.tjzNgDr8p0HfP4Tt")
+        self.glm_api_base = env.get("GLM_API_BASE", "https://open.bigmodel.cn/api/paas/v4/")
+        self.glm_model = env.get("GLM_MODEL", "glm-4.7")
+        self.glm_max_concurrency = int(env.get("GLM_MAX_CONCURRENCY", "32"))
 
         # Server Configuration
-        self.host = os.getenv("HOST", "0.0.0.0")
-        self.port = int(os.getenv("PORT", "8000"))
-        self.debug = os.getenv("DEBUG", "false").lower() == "true"
+        self.host = env.get("HOST", "0.0.0.0")
+        self.port = int(env.get("PORT", "8000"))
+        self.debug = env.get("DEBUG", "false").lower() == "true"
 
         # ESP32 Configuration
-        self.esp32_port = os.getenv("ESP32_PORT", "/dev/ttyUSB0")
-        self.esp32_baud = int(os.getenv("ESP32_BAUD", "115200"))
+        self.esp32_port = env.get("ESP32_PORT", "/dev/ttyUSB0")
+        self.esp32_baud = int(env.get("ESP32_BAUD", "115200"))
 
         # Database
-        self.database_url = os.getenv("DATABASE_URL", "sqlite:///./poofmicro.db")
+        self.database_url = env.get("DATABASE_URL", "sqlite:///./poofmicro.db")
 
         # Paths
-        self.esp32_projects_path = os.getenv("ESP32_PROJECTS_PATH", "./esp32_projects")
+        self.esp32_projects_path = env.get("ESP32_PROJECTS_PATH", "./esp32_projects")
 
 
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Return the process-wide settings instance"""
+    return Settings()
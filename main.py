@@ -1,12 +1,15 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi import Request
 from contextlib import asynccontextmanager
 
 from src.api.routes import router
-from config import settings
+from src.core.builder import ESP32Builder
+from src.services.api_client import GLMClient
+from src.utils.logger import logger
+from config import get_settings
 
 # Add src to Python path for imports
 import sys
@@ -17,11 +20,15 @@ sys.path.insert(0, str(Path(__file__).parent))
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan manager"""
-    # Startup
-    print(f"PoofMicro ESP32 Builder starting on {settings.host}:{settings.port}")
-    yield
+    # Startup: share one GLM client and builder across all requests
+    settings = get_settings()
+    async with GLMClient() as glm:
+        app.state.glm = glm
+        app.state.builder = ESP32Builder(glm_client=glm)
+        logger.info("PoofMicro ESP32 Builder starting on %s:%s", settings.host, settings.port)
+        yield
     # Shutdown
-    print("PoofMicro ESP32 Builder shutting down")
+    logger.info("PoofMicro ESP32 Builder shutting down")
 
 
 # Create FastAPI app
@@ -30,6 +37,7 @@ app = FastAPI(
     description="Full-stack ESP32 program builder powered by GLM 4.7",
     version="0.1.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # Mount static files
@@ -42,6 +50,18 @@ templates = Jinja2Templates(directory="templates")
 app.include_router(router)
 
 
+@app.exception_handler(HTTPException)
+async def http_exception_handler(request: Request, exc: HTTPException):
+    """Return HTTP errors raised by routes as JSON"""
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
+
+
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    """Report unexpected route errors as a 500 with the error message"""
+    return ORJSONResponse({"detail": str(exc)}, status_code=500)
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     """Main UI page"""
@@ -57,9 +77,20 @@ async def health():
 if __name__ == "__main__":
     import uvicorn
 
+    settings = get_settings()
+
+    # uvloop isn't published for Windows; fall back to the stock asyncio loop there
+    try:
+        import uvloop  # noqa: F401
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+
     uvicorn.run(
         "main:app",
         host=settings.host,
         port=settings.port,
         reload=settings.debug,
+        loop=loop,
+        http="httptools",
     )
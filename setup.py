@@ -5,16 +5,19 @@ setup(
     version="0.1.0",
     description="ESP32 Program Builder with GLM 4.7 AI",
     author="Snail3D",
-    packages=find_packages(where="src"),
-    package_dir={"": "src"},
+    packages=find_packages(include=["src", "src.*"]),
+    py_modules=["main", "config"],
     install_requires=[
         "fastapi>=0.109.0",
         "uvicorn[standard]>=0.27.0",
+        "uvloop>=0.19.0; sys_platform != 'win32'",
+        "httptools>=0.6.0",
         "pydantic>=2.5.3",
         "pydantic-settings>=2.1.0",
         "python-dotenv>=1.0.0",
-        "zhipuai>=2.1.5",
-        "httpx>=0.26.0",
+        "httpx[http2]>=0.26.0",
+        "orjson>=3.9.0",
+        "ijson>=3.2.0",
         "jinja2>=3.1.3",
         "aiofiles>=23.2.1",
         "websockets>=12.0",
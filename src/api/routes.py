@@ -1,63 +1,79 @@
-from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.requests import HTTPConnection
+from pydantic import BaseModel, ConfigDict
+from typing import Callable, List, Optional, Dict, Any, Tuple
 from pathlib import Path
-import json
+from functools import lru_cache
+import os
+import time
+import aiofiles
+import orjson
 
 from src.core.builder import ESP32Builder, ESP32Simulator, BuildContext, BuildResult
 from src.services.esp32_hardware import hardware
+from config import get_settings
 
 
 # Request/Response Models
-class LibrarySearchRequest(BaseModel):
+class RequestModel(BaseModel):
+    """Base for request bodies; validators are built at import, not on first request"""
+    model_config = ConfigDict(extra="ignore", frozen=True, defer_build=False)
+
+
+class LibrarySearchRequest(RequestModel):
+    query: str
+    board_type: str = "esp32"
+
+
+class MaterialSearchRequest(RequestModel):
     query: str
     board_type: str = "esp32"
 
 
-class MaterialSearchRequest(BaseModel):
+class EnrichRequest(RequestModel):
     query: str
     board_type: str = "esp32"
 
 
-class BuildRequest(BaseModel):
+class BuildRequest(RequestModel):
     project_name: str
     board_type: str = "esp32"
     description: str
-    features: List[str] = []
-    libraries: List[Dict[str, str]] = []
-    wifi_config: Optional[Dict[str, str]] = None
+    features: list[str] = []
+    libraries: list[dict[str, str]] = []
+    wifi_config: Optional[dict[str, str]] = None
     custom_code: Optional[str] = None
     board_context: Optional[str] = None
-    materials: List[Dict[str, Any]] = []
+    materials: list[dict[str, Any]] = []
 
 
-class SimulateRequest(BaseModel):
+class SimulateRequest(RequestModel):
     project_name: str
     board_type: str = "esp32"
 
 
-class ApiKeyUpdateRequest(BaseModel):
+class ApiKeyUpdateRequest(RequestModel):
     api_key: str
 
 
-class VisionImageSearchRequest(BaseModel):
+class VisionImageSearchRequest(RequestModel):
     object_name: str
     max_images: int = 10
 
 
-class VisionModelRequest(BaseModel):
+class VisionModelRequest(RequestModel):
     object_name: str
     object_description: str = ""
 
 
-class VisionProjectRequest(BaseModel):
+class VisionProjectRequest(RequestModel):
     project_name: str
     objects_to_detect: List[str]
     board_type: str = "esp32-cam"
 
 
-class ChatRequest(BaseModel):
+class ChatRequest(RequestModel):
     message: str
     history: List[Dict[str, str]] = []
 
@@ -71,88 +87,143 @@ class ChatResponse(BaseModel):
 # Router
 router = APIRouter(prefix="/api")
 
-# Global instances
-builder = ESP32Builder()
-simulator = ESP32Simulator()
+# Root directory for generated projects, resolved once at import
+_PROJECTS_ROOT: Path = Path(get_settings().esp32_projects_path).resolve()
+
+# Files larger than this are streamed instead of inlined into a JSON body
+INLINE_FILE_LIMIT = 64 * 1024
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Directory listings are reused for a short time while the directory is unchanged
+SCAN_CACHE_TTL = 2.0
+SCAN_CACHE_SIZE = 128
+_scan_cache: Dict[Tuple[str, int], Tuple[float, List[Dict[str, Any]]]] = {}
+
+
+def get_builder(connection: HTTPConnection) -> ESP32Builder:
+    """Shared builder, created by the application lifespan"""
+    return connection.app.state.builder
+
+
+@lru_cache(maxsize=1)
+def get_simulator() -> ESP32Simulator:
+    """Shared simulator, created on first use"""
+    return ESP32Simulator()
+
+
+@lru_cache(maxsize=2048)
+def _slug(name: str) -> str:
+    """Project directory name for a user-facing project name"""
+    return name.replace(" ", "_").lower()
+
+
+def _cached_scan(path: Path, scan: Callable[[Path], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Return scan(path), reusing a recent result while the directory mtime is unchanged"""
+    key = (str(path), path.stat().st_mtime_ns)
+    now = time.monotonic()
+
+    cached = _scan_cache.get(key)
+    if cached and now - cached[0] < SCAN_CACHE_TTL:
+        return cached[1]
+
+    result = scan(path)
+    if len(_scan_cache) >= SCAN_CACHE_SIZE:
+        _scan_cache.pop(next(iter(_scan_cache)))
+    _scan_cache[key] = (now, result)
+    return result
+
+
+def _scan_projects(projects_path: Path) -> List[Dict[str, Any]]:
+    projects = []
+
+    for project_dir in projects_path.iterdir():
+        if project_dir.is_dir():
+            projects.append({
+                "name": project_dir.name,
+                "path": str(project_dir),
+                "created": project_dir.stat().st_ctime,
+            })
+
+    return projects
 
 
-@router.get("/health")
+def _walk_files(root: str):
+    """Yield a DirEntry for every file below root"""
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
+def _scan_files(project_path: Path) -> List[Dict[str, Any]]:
+    root = os.fspath(project_path)
+    root_len = len(root) + 1
+
+    return [
+        {"name": entry.name, "path": entry.path[root_len:], "size": entry.stat().st_size}
+        for entry in _walk_files(root)
+    ]
+
+
+@router.get("/health", response_model=None)
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "PoofMicro ESP32 Builder"}
 
 
 @router.post("/chat")
-async def chat(request: ChatRequest) -> ChatResponse:
+async def chat(request: ChatRequest, builder: ESP32Builder = Depends(get_builder)) -> ChatResponse:
     """Conversational ESP32 builder using GLM 4.7"""
-    try:
-        response = await builder.chat_conversation(request.message, request.history)
-        return response
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    response = await builder.chat_conversation(request.message, request.history)
+    return response
 
 
 @router.post("/search/libraries")
-async def search_libraries(request: LibrarySearchRequest) -> List[Dict[str, str]]:
+async def search_libraries(request: LibrarySearchRequest, builder: ESP32Builder = Depends(get_builder)) -> List[Dict[str, str]]:
     """Search for ESP32 libraries using GLM 4.7"""
-    try:
-        results = await builder.search_libraries(request.query, request.board_type)
-        return results
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    results = await builder.search_libraries(request.query, request.board_type)
+    return results
 
 
 @router.post("/search/materials")
-async def search_materials(request: MaterialSearchRequest) -> List[Dict[str, Any]]:
+async def search_materials(request: MaterialSearchRequest, builder: ESP32Builder = Depends(get_builder)) -> List[Dict[str, Any]]:
     """Search for ESP32 materials and components"""
-    try:
-        results = await builder.search_materials(request.query, request.board_type)
-        return results
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    results = await builder.search_materials(request.query, request.board_type)
+    return results
+
+
+@router.post("/search/all", response_model=None)
+async def search_all(request: EnrichRequest, builder: ESP32Builder = Depends(get_builder)) -> Dict[str, List[Dict[str, Any]]]:
+    """Search libraries, materials and object images in one request"""
+    return await builder.enrich_context(request.query, request.board_type)
 
 
 @router.post("/build")
-async def build_project(request: BuildRequest) -> BuildResult:
+async def build_project(request: BuildRequest, builder: ESP32Builder = Depends(get_builder)) -> BuildResult:
     """Generate and build ESP32 project"""
-    try:
-        context = BuildContext(
-            project_name=request.project_name,
-            board_type=request.board_type,
-            description=request.description,
-            features=request.features,
-            libraries=request.libraries,
-            wifi_config=request.wifi_config,
-            custom_code=request.custom_code,
-            board_context=request.board_context,
-            materials=request.materials,
-        )
-
-        result = await builder.generate_code(context)
-        return result
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    context = BuildContext(**request.model_dump())
+    result = await builder.generate_code(context)
+    return result
 
 
 @router.post("/simulate")
-async def simulate_project(request: SimulateRequest) -> Dict[str, Any]:
+async def simulate_project(request: SimulateRequest, simulator: ESP32Simulator = Depends(get_simulator)) -> Dict[str, Any]:
     """Simulate an ESP32 project (WACWI-like)"""
-    try:
-        project_path = Path(builder.projects_path) / request.project_name.replace(" ", "_").lower()
+    project_path = _PROJECTS_ROOT / _slug(request.project_name)
 
-        if not project_path.exists():
-            raise HTTPException(status_code=404, detail="Project not found")
+    if not project_path.exists():
+        raise HTTPException(status_code=404, detail="Project not found")
 
-        result = await simulator.simulate_project(project_path, request.board_type)
-        return result
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    result = await simulator.simulate_project(project_path, request.board_type)
+    return result
 
 
-@router.get("/simulate/{project_name}")
-async def get_simulation(project_name: str) -> Dict[str, Any]:
+@router.get("/simulate/{project_name}", response_model=None)
+async def get_simulation(project_name: str, simulator: ESP32Simulator = Depends(get_simulator)) -> Dict[str, Any]:
     """Get simulation status"""
     result = simulator.get_simulation(project_name)
 
@@ -163,7 +234,7 @@ async def get_simulation(project_name: str) -> Dict[str, Any]:
 
 
 @router.delete("/simulate/{project_name}")
-async def stop_simulation(project_name: str) -> Dict[str, str]:
+async def stop_simulation(project_name: str, simulator: ESP32Simulator = Depends(get_simulator)) -> Dict[str, str]:
     """Stop a simulation"""
     success = simulator.stop_simulation(project_name)
 
@@ -176,201 +247,169 @@ async def stop_simulation(project_name: str) -> Dict[str, str]:
 # Vision API Endpoints
 
 @router.post("/vision/search-images")
-async def search_object_images(request: VisionImageSearchRequest) -> List[Dict[str, Any]]:
+async def search_object_images(request: VisionImageSearchRequest, builder: ESP32Builder = Depends(get_builder)) -> List[Dict[str, Any]]:
     """Search for images of an object for training detection models"""
-    try:
-        results = await builder.search_object_images(request.object_name, request.max_images)
-        return results
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    results = await builder.search_object_images(request.object_name, request.max_images)
+    return results
 
 
 @router.post("/vision/create-model")
-async def create_detection_model(request: VisionModelRequest) -> Dict[str, Any]:
+async def create_detection_model(request: VisionModelRequest, builder: ESP32Builder = Depends(get_builder)) -> Dict[str, Any]:
     """Create custom detection model configuration for ESP32"""
-    try:
-        result = await builder.create_detection_model(request.object_name, request.object_description)
-        return result
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    result = await builder.create_detection_model(request.object_name, request.object_description)
+    return result
 
 
 @router.post("/vision/build")
-async def build_vision_project(request: VisionProjectRequest) -> BuildResult:
+async def build_vision_project(request: VisionProjectRequest, builder: ESP32Builder = Depends(get_builder)) -> BuildResult:
     """Build complete ESP32-CAM vision project with custom detection"""
-    try:
-        result = await builder.generate_vision_project(
-            request.project_name,
-            request.objects_to_detect,
-            request.board_type
-        )
-        return result
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    result = await builder.generate_vision_project(
+        request.project_name,
+        request.objects_to_detect,
+        request.board_type
+    )
+    return result
 
 
 # Hardware API Endpoints
 
-@router.get("/hardware/ports")
-async def list_serial_ports() -> List[Dict[str, str]]:
+@router.get("/hardware/ports", response_model=None)
+async def list_serial_ports() -> List[Dict[str, Any]]:
     """List available serial ports"""
-    try:
-        return hardware.list_ports()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return hardware.list_ports()
 
 
-@router.get("/hardware/detect")
+@router.get("/hardware/detect", response_model=None)
 async def detect_esp32() -> Dict[str, Any]:
     """Detect connected ESP32"""
-    try:
-        port = await hardware.detect_esp32()
-        return {
-            "detected": port is not None,
-            "port": port,
-            "all_ports": hardware.list_ports()
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    port = await hardware.detect_esp32()
+    return {
+        "detected": port is not None,
+        "port": port,
+        "all_ports": hardware.list_ports()
+    }
 
 
 @router.post("/hardware/upload")
 async def upload_firmware(project_name: str, port: Optional[str] = None) -> Dict[str, Any]:
     """Upload firmware to ESP32"""
-    try:
-        project_path = Path(builder.projects_path) / project_name.replace(" ", "_").lower()
-
-        if not project_path.exists():
-            raise HTTPException(status_code=404, detail="Project not found")
-
-        # Find the firmware file (could be .bin or use platformio)
-        # For now, use platformio to build and upload
-        result = await hardware.upload_firmware(project_path, port)
-
-        if result.get("success"):
-            return {
-                "success": True,
-                "port": result.get("port"),
-                "message": "Firmware uploaded successfully"
-            }
-        else:
-            raise HTTPException(status_code=500, detail=result.get("error", "Upload failed"))
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    project_path = _PROJECTS_ROOT / _slug(project_name)
 
+    if not project_path.exists():
+        raise HTTPException(status_code=404, detail="Project not found")
 
-@router.post("/hardware/test")
-async def test_on_hardware(project_name: str, test_duration: float = 10.0) -> Dict[str, Any]:
-    """Test uploaded firmware on ESP32 hardware"""
-    try:
-        # Read serial output from the device
-        output = await hardware.read_serial(duration=test_duration)
+    # Find the firmware file (could be .bin or use platformio)
+    # For now, use platformio to build and upload
+    result = await hardware.upload_firmware(project_path, port)
 
+    if result.get("success"):
         return {
             "success": True,
-            "output": output,
-            "test_passed": any("PASS" in line.upper() or "OK" in line.upper() or "READY" in line.upper() for line in output)
+            "port": result.get("port"),
+            "message": "Firmware uploaded successfully"
         }
+    else:
+        raise HTTPException(status_code=500, detail=result.get("error", "Upload failed"))
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/hardware/test")
+async def test_on_hardware(project_name: str, test_duration: float = 10.0) -> Dict[str, Any]:
+    """Test uploaded firmware on ESP32 hardware"""
+    # Read serial output from the device
+    output = await hardware.read_serial(duration=test_duration)
 
-@router.get("/hardware/status")
-async def hardware_status() -> Dict[str, Any]:
+    return {
+        "success": True,
+        "output": output,
+        "test_passed": any("PASS" in line.upper() or "OK" in line.upper() or "READY" in line.upper() for line in output)
+    }
+
+
+@router.get("/hardware/status", response_model=None)
+async def hardware_status(include_ports: bool = False) -> Dict[str, Any]:
     """Get hardware connection status"""
-    try:
-        return hardware.get_status()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return hardware.get_status(include_ports)
 
 
-@router.get("/projects")
+@router.get("/projects", response_model=None)
 async def list_projects() -> List[Dict[str, Any]]:
     """List all projects"""
-    try:
-        projects_path = Path(builder.projects_path)
-        projects = []
-
-        for project_dir in projects_path.iterdir():
-            if project_dir.is_dir():
-                projects.append({
-                    "name": project_dir.name,
-                    "path": str(project_dir),
-                    "created": project_dir.stat().st_ctime,
-                })
+    if not _PROJECTS_ROOT.is_dir():
+        return []
 
-        return projects
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return _cached_scan(_PROJECTS_ROOT, _scan_projects)
 
 
-@router.get("/projects/{project_name}/files")
+@router.get("/projects/{project_name}/files", response_model=None)
 async def get_project_files(project_name: str) -> List[Dict[str, Any]]:
     """Get project files"""
-    try:
-        project_path = Path(builder.projects_path) / project_name.replace(" ", "_").lower()
-
-        if not project_path.exists():
-            raise HTTPException(status_code=404, detail="Project not found")
-
-        files = []
-        for file_path in project_path.rglob("*"):
-            if file_path.is_file():
-                files.append({
-                    "name": file_path.name,
-                    "path": str(file_path.relative_to(project_path)),
-                    "size": file_path.stat().st_size,
-                })
+    project_path = _PROJECTS_ROOT / _slug(project_name)
 
-        return files
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    if not project_path.exists():
+        raise HTTPException(status_code=404, detail="Project not found")
+
+    return _cached_scan(project_path, _scan_files)
 
 
 @router.get("/projects/{project_name}/file/{file_path:path}")
 async def get_project_file(project_name: str, file_path: str) -> Dict[str, str]:
     """Get specific file content"""
-    try:
-        project_path = Path(builder.projects_path) / project_name.replace(" ", "_").lower()
-        full_path = project_path / file_path
+    projects_root = os.fspath(_PROJECTS_ROOT)
+    root = os.path.realpath(os.path.join(projects_root, _slug(project_name)))
+    full_path = os.path.realpath(os.path.join(root, file_path))
 
-        if not full_path.exists():
-            raise HTTPException(status_code=404, detail="File not found")
+    # Reject paths that resolve outside the project directory
+    if os.path.dirname(root) != projects_root or os.path.commonpath([root, full_path]) != root:
+        raise HTTPException(status_code=404, detail="File not found")
 
-        content = full_path.read_text()
+    try:
+        size = os.stat(full_path).st_size
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    name = os.path.basename(full_path)
+
+    if size > INLINE_FILE_LIMIT:
+        async def iter_file():
+            async with aiofiles.open(full_path, "rb") as f:
+                while chunk := await f.read(FILE_CHUNK_SIZE):
+                    yield chunk
+
+        return StreamingResponse(
+            iter_file(),
+            media_type="text/plain; charset=utf-8",
+            headers={"X-File-Name": name},
+        )
 
-        return {
-            "name": full_path.name,
-            "path": file_path,
-            "content": content,
-        }
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    async with aiofiles.open(full_path, "rb") as f:
+        content = await f.read()
+
+    return {
+        "name": name,
+        "path": file_path,
+        "content": content.decode("utf-8"),
+    }
 
 
 @router.websocket("/ws/build")
-async def websocket_build(websocket: WebSocket):
+async def websocket_build(websocket: WebSocket, builder: ESP32Builder = Depends(get_builder)):
     """WebSocket for real-time build updates"""
     await websocket.accept()
 
+    async def send(message: Dict[str, Any]):
+        # orjson encodes dataclasses natively; default=str covers Path fields
+        await websocket.send_text(orjson.dumps(message, default=str).decode())
+
     try:
         while True:
-            data = await websocket.receive_json()
+            data = orjson.loads(await websocket.receive_text())
 
             if data.get("type") == "build":
                 # Process build and send updates
                 context = BuildContext(**data.get("context", {}))
 
                 # Send progress updates
-                await websocket.send_json({
+                await send({
                     "type": "progress",
                     "message": "Starting build...",
                     "progress": 10,
@@ -378,21 +417,18 @@ async def websocket_build(websocket: WebSocket):
 
                 result = await builder.generate_code(context)
 
-                await websocket.send_json({
-                    "type": "progress",
-                    "message": "Code generated...",
-                    "progress": 50,
-                })
-
-                await websocket.send_json({
+                # Final progress and result go out in a single frame
+                await send({
                     "type": "complete",
-                    "result": result.__dict__,
+                    "message": "Code generated",
+                    "progress": 100,
+                    "result": result,
                 })
 
     except WebSocketDisconnect:
         pass
     except Exception as e:
-        await websocket.send_json({
+        await send({
             "type": "error",
             "message": str(e),
         })
@@ -1,16 +1,268 @@
 import asyncio
-import json
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+import orjson
+import ijson
 from pathlib import Path
-from typing import Optional, Dict, Any, List
+from typing import AsyncIterator, Awaitable, Collection, Final, Optional, Dict, Any, List, Set, Tuple
 from dataclasses import dataclass, field
 from datetime import datetime
 import httpx
+import aiofiles
 
-from zhipuai import ZhipuAI
-from config import settings
+from config import get_settings
+from src.services.api_client import GLMClient
 
+# Search results are reused for a day and persisted in the projects directory
+SEARCH_CACHE_TTL = 24 * 60 * 60
+SEARCH_CACHE_FILE = ".glm_cache.json"
+# Searches run deterministically so repeated queries are worth caching
+SEARCH_TEMPERATURE = 0.0
 
-@dataclass
+# Ask GLM for a bare JSON object instead of prose or a fenced code block
+JSON_MODE = {"type": "json_object"}
+
+_SYSTEM_PROMPT_CODER: Final[str] = """You are an expert ESP32 developer. Generate clean, well-documented C++ code for ESP32 projects.
+
+Always respond with valid JSON in this exact format:
+{
+  "files": {
+    "src/main.cpp": "// code here",
+    "include/config.h": "// code here"
+  },
+  "platformio_ini": "// platformio.ini content",
+  "config": {
+    "board": "esp32dev",
+    "framework": "arduino",
+    "lib_deps": ["lib1", "lib2"]
+  }
+}
+
+Requirements:
+- Use modern C++ practices
+- Include comprehensive comments
+- Follow Arduino/ESP32 conventions
+- Handle errors appropriately
+- Include Serial debugging at 115200 baud
+- Never use emojis
+- Keep code modular and organized"""
+
+_SYSTEM_PROMPT_VISION: Final[str] = """You are an expert ESP32-CAM and computer vision developer. Generate complete, production-ready code for object detection projects.
+
+Always respond with valid JSON in this exact format:
+{
+  "files": {
+    "src/main.cpp": "// complete code",
+    "include/config.h": "// configuration"
+  },
+  "platformio_ini": "// complete config",
+  "config": {}
+}
+
+Requirements for ESP32-CAM projects:
+- Use ESP32-CAM (AI-Thinker) pinout
+- Enable camera with correct pin configuration
+- Include TensorFlow Lite for Microcontrollers
+- Use JPEG compression for web streaming
+- Handle PSRAM allocation properly
+- Include proper error handling
+- Support WiFi for web interface
+- Draw detection boxes on JPEG frames
+- Serial output at 115200 baud for debugging
+- No emojis, clean professional code"""
+
+# System messages are shared by every request; callers only add their user message
+_SYSTEM_MSG_CODER: Final[Dict[str, str]] = {"role": "system", "content": _SYSTEM_PROMPT_CODER}
+_SYSTEM_MSG_VISION: Final[Dict[str, str]] = {"role": "system", "content": _SYSTEM_PROMPT_VISION}
+_SYSTEM_MSG_LIBRARIES: Final[Dict[str, str]] = {"role": "system", "content": "You are an ESP32 library expert."}
+_SYSTEM_MSG_MATERIALS: Final[Dict[str, str]] = {"role": "system", "content": "You are an ESP32 hardware expert."}
+_SYSTEM_MSG_IMAGES: Final[Dict[str, str]] = {"role": "system", "content": "You are a computer vision and machine learning expert."}
+_SYSTEM_MSG_DETECTION: Final[Dict[str, str]] = {
+    "role": "system",
+    "content": "You are an ESP32-CAM and machine learning expert. Generate complete, working code.",
+}
+
+_LIB_PROMPT_TEMPLATE: Final[str] = """Search for ESP32 libraries related to: {query}
+
+Board type: {board_type}
+
+Return a JSON object with this exact structure:
+{{
+  "libraries": [
+    {{
+      "name": "Library Name",
+      "version": "1.0.0",
+      "author": "Author Name",
+      "url": "https://github.com/...",
+      "description": "Brief description",
+      "platformio_name": "library_name"
+    }}
+  ]
+}}"""
+
+_MATERIALS_PROMPT_TEMPLATE: Final[str] = """Search for ESP32 project materials and components related to: {query}
+
+Board type: {board_type}
+
+Return a JSON object with this exact structure:
+{{
+  "materials": [
+    {{
+      "name": "Component/Material Name",
+      "category": "sensor|actuator|communication|power|display|other",
+      "description": "Description of what it does",
+      "pin_count": 4,
+      "voltage": "3.3V",
+      "protocol": "I2C|SPI|UART|GPIO|Analog",
+      "library_needed": "Library Name",
+      "example_url": "https://...",
+      "typical_use_case": "Brief use case description"
+    }}
+  ]
+}}"""
+
+# A reply wrapped in a single markdown code fence (closing fence optional for truncated replies).
+# Anchored so fences inside JSON string values, e.g. a README's code blocks, are left alone
+_JSON_FENCE = re.compile(r"\s*```(?:json)?[^\S\n]*\n?(.*?)(?:\n?```)?\s*", re.DOTALL)
+
+
+def _strip_fence(content: str) -> str:
+    """Return the body of the code fence content is wrapped in, or content itself"""
+    match = _JSON_FENCE.fullmatch(content)
+    return (match.group(1) if match else content).strip()
+
+
+_TS_CACHE = (float("-inf"), "")
+
+
+def _now_iso() -> str:
+    """Current local time in ISO format, refreshed at most once per second"""
+    global _TS_CACHE
+    now = time.monotonic()
+    if now - _TS_CACHE[0] < 1:
+        return _TS_CACHE[1]
+    stamp = datetime.now().isoformat()
+    _TS_CACHE = (now, stamp)
+    return stamp
+
+
+def _parse_json_object(content: str) -> Optional[Dict[str, Any]]:
+    """Decode a (possibly fenced) JSON object, rejecting prose up front without decoding"""
+    content = _strip_fence(content)
+    if not content.startswith("{") or not content.endswith("}"):
+        return None
+    try:
+        parsed = orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def _make_dirs(directories: Collection[Path]):
+    for directory in sorted(directories):
+        directory.mkdir(parents=True, exist_ok=True)
+
+
+def _write_file(path: Path, content: str):
+    path.write_bytes(content.encode("utf-8"))
+
+
+async def _write_file_after(directory_ready: Awaitable[None], path: Path, content: str):
+    """Write a file off the event loop once its directory exists"""
+    await directory_ready
+    await asyncio.to_thread(_write_file, path, content)
+
+
+_JSON_TOKEN = re.compile(r'[{}"\\]')
+
+
+class _ObjectScanner:
+    """Track JSON brace depth across streamed text, ignoring braces inside strings"""
+
+    __slots__ = ("_offset", "_depth", "_start", "_in_string", "_escape_at")
+
+    def __init__(self):
+        self._offset = 0
+        self._depth = 0
+        self._start = 0
+        self._in_string = False
+        # Offset of a character escaped by a backslash (possibly at the start of the next delta)
+        self._escape_at = -1
+
+    def feed(self, delta: str) -> List[Tuple[int, int]]:
+        """Return the (start, end) offsets, in all text fed so far, of the top-level objects delta closes"""
+        closed = []
+        for match in _JSON_TOKEN.finditer(delta):
+            pos = self._offset + match.start()
+            char = match.group()
+            if pos == self._escape_at:
+                continue
+            if self._in_string:
+                if char == "\\":
+                    self._escape_at = pos + 1
+                elif char == '"':
+                    self._in_string = False
+            elif char == "{":
+                if self._depth == 0:
+                    self._start = pos
+                self._depth += 1
+            elif self._depth == 0:
+                # Quotes and stray braces in prose around the object
+                continue
+            elif char == '"':
+                self._in_string = True
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    closed.append((self._start, pos + 1))
+        self._offset += len(delta)
+        return closed
+
+
+class _CompletionStream:
+    """Async file-like view over a streamed completion, for incremental JSON parsing"""
+
+    def __init__(self, deltas: AsyncIterator[str]):
+        self._deltas = deltas
+        self._parts: List[str] = []
+        self._in_json = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    async def read(self, size: int = -1) -> bytes:
+        while True:
+            delta = await anext(self._deltas, None)
+            if delta is None:
+                return b""
+
+            self._parts.append(delta)
+
+            # Skip any prose or code fence in front of the JSON object
+            if not self._in_json:
+                start = delta.find("{")
+                if start < 0:
+                    continue
+                self._in_json = True
+                delta = delta[start:]
+
+            return delta.encode("utf-8")
+
+    async def drain(self):
+        """Consume the rest of the completion"""
+        while await self.read():
+            pass
+
+    async def aclose(self):
+        """Stop the underlying completion stream, releasing its connection"""
+        await self._deltas.aclose()
+
+
+@dataclass(slots=True)
 class BuildContext:
     """Context for ESP32 project build"""
     project_name: str
@@ -24,20 +276,14 @@ class BuildContext:
     materials: List[Dict[str, Any]] = field(default_factory=list)
 
     def to_dict(self) -> Dict[str, Any]:
-        return {
-            "project_name": self.project_name,
-            "board_type": self.board_type,
-            "description": self.description,
-            "features": self.features,
-            "libraries": self.libraries,
-            "wifi_config": self.wifi_config,
-            "custom_code": self.custom_code,
-            "board_context": self.board_context,
-            "materials": self.materials,
-        }
+        # Shallow copy straight from the slots; asdict() would deep-copy every list and dict
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def to_json(self) -> bytes:
+        return orjson.dumps(self)
 
 
-@dataclass
+@dataclass(slots=True)
 class BuildResult:
     """Result of a build operation"""
     success: bool
@@ -47,17 +293,37 @@ class BuildResult:
     platformio_ini: str = ""
     error: Optional[str] = None
     build_log: List[str] = field(default_factory=list)
-    timestamp: str = field(default_factory=lambda: datetime.now().isoformat())
+    timestamp: str = field(default_factory=_now_iso)
 
 
 class ESP32Builder:
     """ESP32 Program Builder using GLM 4.7"""
 
-    def __init__(self):
-        self.client = ZhipuAI(api_key=settings.glm_api_key)
+    def __init__(self, glm_client: Optional[GLMClient] = None):
+        settings = get_settings()
+        self._owns_glm = glm_client is None
+        self.glm = glm_client or GLMClient()
         self.model = settings.glm_model
         self.projects_path = Path(settings.esp32_projects_path)
         self.projects_path.mkdir(exist_ok=True)
+        self._search_cache: Optional[Dict[str, Dict[str, Any]]] = None
+        self._search_cache_lock = asyncio.Lock()
+
+    async def _chat(self, messages: List[Dict[str, str]], temperature: float, **kwargs) -> str:
+        """Run a chat completion and return the reply text"""
+        response = await self.glm.chat_completion(messages=messages, temperature=temperature, **kwargs)
+        return response["choices"][0]["message"]["content"]
+
+    async def aclose(self):
+        """Close the GLM client if this builder created it"""
+        if self._owns_glm:
+            await self.glm.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
 
     async def chat_conversation(self, message: str, history: List[Dict[str, str]] = None) -> Dict[str, Any]:
         """Handle AI-driven conversational building with full autonomy"""
@@ -126,8 +392,7 @@ Be conversational but thorough. Build the PRD incrementally. Ask questions when
         system_prompt = prompt_template.format(hardware_context, detected_str, port_str)
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
+            deltas = self.glm.stream_chat_completion(
                 messages=[
                     {"role": "system", "content": system_prompt},
                     *conversation
@@ -135,18 +400,31 @@ Be conversational but thorough. Build the PRD incrementally. Ask questions when
                 temperature=0.8,
             )
 
-            content = response.choices[0].message.content.strip()
-
-            # Try to extract JSON from the response
-            json_content = content
-            if "```json" in json_content:
-                json_content = json_content.split("```json")[1].split("```")[0].strip()
-            elif "```" in json_content:
-                json_content = json_content.split("```")[1].split("```")[0].strip()
-
-            try:
-                parsed = json.loads(json_content)
-
+            # Stream the reply and stop as soon as it holds a complete spec, skipping any trailing text.
+            # Only a top-level object that just closed is decoded, not the whole reply on every brace
+            parts: List[str] = []
+            parsed = None
+            scanner = _ObjectScanner()
+            spec_found = False
+            async with aclosing(deltas):
+                async for delta in deltas:
+                    parts.append(delta)
+                    closed = scanner.feed(delta)
+                    if closed:
+                        text = "".join(parts)
+                        for start, end in closed:
+                            parsed = _parse_json_object(text[start:end])
+                            spec_found = parsed is not None and ("prdUpdate" in parsed or "projectSpec" in parsed)
+                            if spec_found:
+                                break
+                    if spec_found:
+                        break
+
+            content = "".join(parts).strip()
+            if parsed is None:
+                parsed = _parse_json_object(content[:content.rfind("}") + 1])
+
+            if parsed is not None:
                 return {
                     "message": parsed.get("message", content),
                     "projectSpec": parsed.get("prdUpdate", parsed.get("projectSpec")),
@@ -158,17 +436,16 @@ Be conversational but thorough. Build the PRD incrementally. Ask questions when
                     }
                 }
 
-            except json.JSONDecodeError:
-                # Conversational response without JSON
-                return {
-                    "message": content,
-                    "projectSpec": None,
-                    "needsInput": True,
-                    "hardware": {
-                        "detected": detected_esp32 is not None,
-                        "port": detected_esp32 or "simulation"
-                    }
+            # Conversational response without JSON
+            return {
+                "message": content,
+                "projectSpec": None,
+                "needsInput": True,
+                "hardware": {
+                    "detected": detected_esp32 is not None,
+                    "port": detected_esp32 or "simulation"
                 }
+            }
 
         except Exception as e:
             return {
@@ -180,45 +457,31 @@ Be conversational but thorough. Build the PRD incrementally. Ask questions when
 
     async def search_libraries(self, query: str, board_type: str = "esp32") -> List[Dict[str, str]]:
         """Search for ESP32 libraries using GLM 4.7"""
-        prompt = f"""Search for ESP32 libraries related to: {query}
+        cache_key = self._search_cache_key("libraries", query, board_type)
+        cached = await self._get_cached_search(cache_key)
+        if cached is not None:
+            return cached
 
-Board type: {board_type}
-
-Return a JSON array of libraries with this exact structure:
-[
-  {{
-    "name": "Library Name",
-    "version": "1.0.0",
-    "author": "Author Name",
-    "url": "https://github.com/...",
-    "description": "Brief description",
-    "platformio_name": "library_name"
-  }}
-]
-
-Only return valid JSON, no other text."""
+        prompt = _LIB_PROMPT_TEMPLATE.format(query=query, board_type=board_type)
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
+            content = _strip_fence(await self._chat(
                 messages=[
-                    {"role": "system", "content": "You are an ESP32 library expert. Always respond with valid JSON only."},
+                    _SYSTEM_MSG_LIBRARIES,
                     {"role": "user", "content": prompt}
                 ],
-                temperature=0.3,
-            )
-
-            content = response.choices[0].message.content.strip()
+                temperature=SEARCH_TEMPERATURE,
+                response_format=JSON_MODE,
+            ))
 
-            # Clean up markdown code blocks if present
-            if content.startswith("```"):
-                content = content.split("```")[1]
-                if content.startswith("json"):
-                    content = content[4:]
-                content = content.strip()
+            libraries = orjson.loads(content)
+            if isinstance(libraries, dict):
+                libraries = libraries.get("libraries")
+            if not isinstance(libraries, list):
+                return []
 
-            libraries = json.loads(content)
-            return libraries if isinstance(libraries, list) else []
+            await self._store_search(cache_key, libraries)
+            return libraries
 
         except Exception as e:
             print(f"Library search error: {e}")
@@ -226,54 +489,108 @@ Only return valid JSON, no other text."""
 
     async def search_materials(self, query: str, board_type: str = "esp32") -> List[Dict[str, Any]]:
         """Search for ESP32 project materials, components, and references"""
-        prompt = f"""Search for ESP32 project materials and components related to: {query}
-
-Board type: {board_type}
-
-Return a JSON array of materials with this exact structure:
-[
-  {{
-    "name": "Component/Material Name",
-    "category": "sensor|actuator|communication|power|display|other",
-    "description": "Description of what it does",
-    "pin_count": 4,
-    "voltage": "3.3V",
-    "protocol": "I2C|SPI|UART|GPIO|Analog",
-    "library_needed": "Library Name",
-    "example_url": "https://...",
-    "typical_use_case": "Brief use case description"
-  }}
-]
+        cache_key = self._search_cache_key("materials", query, board_type)
+        cached = await self._get_cached_search(cache_key)
+        if cached is not None:
+            return cached
 
-Only return valid JSON, no other text."""
+        prompt = _MATERIALS_PROMPT_TEMPLATE.format(query=query, board_type=board_type)
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
+            content = _strip_fence(await self._chat(
                 messages=[
-                    {"role": "system", "content": "You are an ESP32 hardware expert. Always respond with valid JSON only."},
+                    _SYSTEM_MSG_MATERIALS,
                     {"role": "user", "content": prompt}
                 ],
-                temperature=0.3,
-            )
+                temperature=SEARCH_TEMPERATURE,
+                response_format=JSON_MODE,
+            ))
 
-            content = response.choices[0].message.content.strip()
+            materials = orjson.loads(content)
+            if isinstance(materials, dict):
+                materials = materials.get("materials")
+            if not isinstance(materials, list):
+                return []
 
-            if content.startswith("```"):
-                content = content.split("```")[1]
-                if content.startswith("json"):
-                    content = content[4:]
-                content = content.strip()
-
-            materials = json.loads(content)
-            return materials if isinstance(materials, list) else []
+            await self._store_search(cache_key, materials)
+            return materials
 
         except Exception as e:
             print(f"Materials search error: {e}")
             return []
 
+    def _search_cache_key(self, method: str, query: str, board_type: str) -> str:
+        raw = "\0".join((method, self.model, query, board_type))
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+    async def _load_search_cache(self) -> Dict[str, Dict[str, Any]]:
+        """Load the persisted search cache on first use"""
+        if self._search_cache is None:
+            try:
+                data = await asyncio.to_thread((self.projects_path / SEARCH_CACHE_FILE).read_bytes)
+                loaded = orjson.loads(data)
+            except (OSError, ValueError):
+                loaded = {}
+            # Another search may have loaded it while this one was waiting on the read
+            if self._search_cache is None:
+                self._search_cache = loaded
+        return self._search_cache
+
+    async def _get_cached_search(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        entry = (await self._load_search_cache()).get(key)
+        if entry and time.time() - entry["at"] < SEARCH_CACHE_TTL:
+            return entry["value"]
+        return None
+
+    async def _store_search(self, key: str, value: List[Dict[str, Any]]):
+        cache = await self._load_search_cache()
+        now = time.time()
+
+        # Drop expired entries so the cache file doesn't grow forever
+        for stale in [k for k, entry in cache.items() if now - entry["at"] >= SEARCH_CACHE_TTL]:
+            del cache[stale]
+
+        cache[key] = {"at": now, "value": value}
+        data = orjson.dumps(cache)
+        try:
+            async with self._search_cache_lock:
+                await asyncio.to_thread((self.projects_path / SEARCH_CACHE_FILE).write_bytes, data)
+        except OSError as e:
+            print(f"Search cache write error: {e}")
+
+    async def prepare_context(
+        self,
+        context: BuildContext,
+        library_query: Optional[str] = None,
+        material_query: Optional[str] = None,
+    ) -> BuildContext:
+        """Fill in libraries and materials for a build, running both searches concurrently"""
+        libraries, materials = await asyncio.gather(
+            self.search_libraries(library_query or context.description, context.board_type),
+            self.search_materials(material_query or context.description, context.board_type),
+        )
+
+        context.libraries = libraries
+        context.materials = materials
+        return context
+
+    async def enrich_context(self, query: str, board_type: str = "esp32") -> Dict[str, List[Dict[str, Any]]]:
+        """Search libraries, materials and object images for a query concurrently"""
+        libraries, materials, images = await asyncio.gather(
+            self.search_libraries(query, board_type),
+            self.search_materials(query, board_type),
+            self.search_object_images(query),
+        )
+
+        return {"libraries": libraries, "materials": materials, "images": images}
+
     async def search_object_images(self, object_name: str, max_images: int = 10) -> List[Dict[str, Any]]:
         """Search for images of an object for training detection models"""
+        cache_key = self._search_cache_key("images", object_name, "")
+        cached = await self._get_cached_search(cache_key)
+        if cached is not None:
+            return cached
+
         prompt = f"""I need to find images and information about "{object_name}" for training an ESP32-CAM object detection model.
 
 Provide a JSON response with this structure:
@@ -296,29 +613,24 @@ Provide a JSON response with this structure:
     "brightness": "0",
     "contrast": "0"
   }}
-}}
-
-Only return valid JSON, no other text."""
+}}"""
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
+            content = _strip_fence(await self._chat(
                 messages=[
-                    {"role": "system", "content": "You are a computer vision and machine learning expert. Always respond with valid JSON only."},
+                    _SYSTEM_MSG_IMAGES,
                     {"role": "user", "content": prompt}
                 ],
-                temperature=0.3,
-            )
-
-            content = response.choices[0].message.content.strip()
+                temperature=SEARCH_TEMPERATURE,
+                response_format=JSON_MODE,
+            ))
 
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
+            result = orjson.loads(content)
+            if not isinstance(result, dict):
+                return []
 
-            result = json.loads(content)
-            return [result] if isinstance(result, dict) else []
+            await self._store_search(cache_key, [result])
+            return [result]
 
         except Exception as e:
             print(f"Object image search error: {e}")
@@ -365,28 +677,19 @@ Generate complete, working code that:
 3. Draws bounding boxes on detected objects
 4. Sends results via Serial and/or WiFi
 5. Uses TensorFlow Lite for Microcontrollers
-6. Includes error handling and debugging
-
-Only return valid JSON, no other text."""
+6. Includes error handling and debugging"""
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
+            content = _strip_fence(await self._chat(
                 messages=[
-                    {"role": "system", "content": "You are an ESP32-CAM and machine learning expert. Generate complete, working code. Always respond with valid JSON only."},
+                    _SYSTEM_MSG_DETECTION,
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.4,
-            )
-
-            content = response.choices[0].message.content.strip()
+                response_format=JSON_MODE,
+            ))
 
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
-
-            result = json.loads(content)
+            result = orjson.loads(content)
             return result if isinstance(result, dict) else {}
 
         except Exception as e:
@@ -409,12 +712,12 @@ Only return valid JSON, no other text."""
             features=["camera", "wifi", "webserver", "detection"],
         )
 
-        # Generate detection model for first object
-        primary_object = objects_to_detect[0]
-        model_config = await self.create_detection_model(
-            primary_object,
-            f"Primary detection object: {primary_object}"
-        )
+        # Generate a detection model for every object concurrently; the first one drives the project
+        model_configs = await asyncio.gather(*(
+            self.create_detection_model(obj, f"{'Primary' if i == 0 else 'Secondary'} detection object: {obj}")
+            for i, obj in enumerate(objects_to_detect)
+        ))
+        model_config = model_configs[0]
 
         if not model_config:
             result.error = "Failed to generate detection model"
@@ -424,38 +727,26 @@ Only return valid JSON, no other text."""
         prompt = self._build_vision_prompt(context, objects_to_detect, model_config)
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
+            content = await self._chat(
                 messages=[
-                    {"role": "system", "content": self._get_vision_system_prompt()},
+                    _SYSTEM_MSG_VISION,
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.4,
+                response_format=JSON_MODE,
             )
 
-            content = response.choices[0].message.content
             parsed = self._parse_generation_response(content)
 
             result.code_files = parsed.get("files", {})
             result.platformio_ini = parsed.get("platformio_ini", "")
             result.config = parsed.get("config", {})
             result.config["model_config"] = model_config
+            result.config["model_configs"] = {
+                obj: config for obj, config in zip(objects_to_detect, model_configs) if config
+            }
 
-            # Create project directory and files
-            project_path = self.projects_path / context.project_name.replace(" ", "_").lower()
-            project_path.mkdir(exist_ok=True)
-
-            result.project_path = project_path
-
-            # Write generated files
-            for filename, code_content in result.code_files.items():
-                file_path = project_path / filename
-                file_path.parent.mkdir(parents=True, exist_ok=True)
-                file_path.write_text(code_content)
-
-            # Write platformio.ini
-            if result.platformio_ini:
-                (project_path / "platformio.ini").write_text(result.platformio_ini)
+            project_path = await self._write_project(context, result)
 
             result.success = True
             result.build_log.append(f"Vision project created at: {project_path}")
@@ -467,32 +758,10 @@ Only return valid JSON, no other text."""
 
         return result
 
-    def _get_vision_system_prompt(self) -> str:
-        return """You are an expert ESP32-CAM and computer vision developer. Generate complete, production-ready code for object detection projects.
-
-Always respond with valid JSON in this exact format:
-{
-  "files": {
-    "src/main.cpp": "// complete code",
-    "include/config.h": "// configuration"
-  },
-  "platformio_ini": "// complete config",
-  "config": {}
-}
-
-Requirements for ESP32-CAM projects:
-- Use ESP32-CAM (AI-Thinker) pinout
-- Enable camera with correct pin configuration
-- Include TensorFlow Lite for Microcontrollers
-- Use JPEG compression for web streaming
-- Handle PSRAM allocation properly
-- Include proper error handling
-- Support WiFi for web interface
-- Draw detection boxes on JPEG frames
-- Serial output at 115200 baud for debugging
-- No emojis, clean professional code"""
-
     def _build_vision_prompt(self, context: BuildContext, objects: List[str], model_config: Dict[str, Any]) -> str:
+        model_info = model_config.get("model_info") or {}
+        object_lines = "\n".join([f"- {obj}" for obj in objects])
+
         prompt = f"""Generate a complete ESP32-CAM object detection project.
 
 Project Name: {context.project_name}
@@ -500,12 +769,12 @@ Board Type: {context.board_type}
 Description: {context.description}
 
 Objects to Detect:
-{chr(10).join(f'- {obj}' for obj in objects)}
+{object_lines}
 
 Model Configuration:
-- Model: {model_config.get('model_info', {}).get('type', 'MobileNetSSD')}
-- Input Size: {model_config.get('model_info', {}).get('input_size', '96x96')}
-- Classes: {model_config.get('model_info', {}).get('classes', ['background', objects[0]])}
+- Model: {model_info.get('type', 'MobileNetSSD')}
+- Input Size: {model_info.get('input_size', '96x96')}
+- Classes: {model_info.get('classes', ['background', objects[0]])}
 
 Generate:
 1. Complete ESP32-CAM detection code (main.cpp)
@@ -540,40 +809,96 @@ Respond only with valid JSON."""
         prompt = self._build_generation_prompt(context)
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
+            project_path = self._project_path(context)
+
+            stream = _CompletionStream(self.glm.stream_chat_completion(
                 messages=[
-                    {"role": "system", "content": self._get_system_prompt()},
+                    _SYSTEM_MSG_CODER,
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.5,
-            )
-
-            content = response.choices[0].message.content
+                response_format=JSON_MODE,
+            ))
+
+            # Write each file as soon as its entry is complete, while the rest is still generating.
+            # Directories are created when their first file arrives (one mkdir per directory), so a
+            # failed request leaves no empty project behind
+            streamed: Dict[str, str] = {}
+            directories: Dict[Path, asyncio.Task] = {}
+            writes: List[asyncio.Task] = []
+            try:
+                try:
+                    async for filename, code_content in ijson.kvitems_async(stream, "files"):
+                        if isinstance(code_content, str):
+                            streamed[filename] = code_content
+                            path = project_path / filename
+                            if path.parent not in directories:
+                                directories[path.parent] = asyncio.create_task(
+                                    asyncio.to_thread(path.parent.mkdir, parents=True, exist_ok=True)
+                                )
+                            writes.append(asyncio.create_task(
+                                _write_file_after(directories[path.parent], path, code_content)
+                            ))
+                except ijson.JSONError:
+                    # Not clean JSON (e.g. a trailing code fence); the full parse below covers it
+                    pass
+
+                await stream.drain()
+                await asyncio.gather(*directories.values(), *writes)
+            finally:
+                # On failure, don't leave file tasks running unobserved or the stream open
+                pending = [*directories.values(), *writes]
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                await stream.aclose()
 
             # Parse the response
-            parsed = self._parse_generation_response(content)
-            result.code_files = parsed.get("files", {})
+            parsed = self._parse_generation_response(stream.text)
+            result.code_files = parsed.get("files") or streamed
             result.platformio_ini = parsed.get("platformio_ini", "")
             result.config = parsed.get("config", {})
 
-            # Create project directory and files
-            project_path = self.projects_path / context.project_name.replace(" ", "_").lower()
-            project_path.mkdir(exist_ok=True)
+            await self._write_project(context, result, written=streamed.keys())
+
+            result.success = True
+            result.build_log.append(f"Project created at: {project_path}")
+
+        except Exception as e:
+            result.error = str(e)
+            result.build_log.append(f"Error: {e}")
+
+        return result
+
+    async def build_all(self, context: BuildContext) -> BuildResult:
+        """Pick libraries and materials and generate the code in a single GLM request"""
+        result = BuildResult(success=False)
 
-            result.project_path = project_path
+        prompt = self._build_combined_prompt(context)
 
-            # Write generated files
-            for filename, code_content in result.code_files.items():
-                file_path = project_path / filename
-                file_path.parent.mkdir(parents=True, exist_ok=True)
-                file_path.write_text(code_content)
+        try:
+            content = await self._chat(
+                messages=[
+                    _SYSTEM_MSG_CODER,
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.5,
+                response_format=JSON_MODE,
+            )
+
+            parsed = self._parse_generation_response(content)
+            context.libraries = parsed.get("libraries") or context.libraries
+            context.materials = parsed.get("materials") or context.materials
+
+            result.code_files = parsed.get("files", {})
+            result.platformio_ini = parsed.get("platformio_ini", "")
+            result.config = parsed.get("config", {})
 
-            # Write platformio.ini
-            if result.platformio_ini:
-                (project_path / "platformio.ini").write_text(result.platformio_ini)
+            project_path = await self._write_project(context, result)
 
             result.success = True
+            result.build_log.append(f"Libraries: {', '.join(lib.get('name', 'N/A') for lib in context.libraries)}")
+            result.build_log.append(f"Materials: {', '.join(mat.get('name', 'N/A') for mat in context.materials)}")
             result.build_log.append(f"Project created at: {project_path}")
 
         except Exception as e:
@@ -582,64 +907,63 @@ Respond only with valid JSON."""
 
         return result
 
-    def _get_system_prompt(self) -> str:
-        return """You are an expert ESP32 developer. Generate clean, well-documented C++ code for ESP32 projects.
+    def _project_path(self, context: BuildContext) -> Path:
+        return self.projects_path / context.project_name.replace(" ", "_").lower()
 
-Always respond with valid JSON in this exact format:
-{
-  "files": {
-    "src/main.cpp": "// code here",
-    "include/config.h": "// code here"
-  },
-  "platformio_ini": "// platformio.ini content",
-  "config": {
-    "board": "esp32dev",
-    "framework": "arduino",
-    "lib_deps": ["lib1", "lib2"]
-  }
-}
+    async def _write_project(self, context: BuildContext, result: BuildResult, written: Collection[str] = ()) -> Path:
+        """Write the generated files in result to the project directory, skipping those already written"""
+        if not result.code_files and not result.platformio_ini:
+            # Prose, an empty reply or unparseable JSON: don't leave an empty project behind
+            raise ValueError("GLM response contained no project files")
 
-Requirements:
-- Use modern C++ practices
-- Include comprehensive comments
-- Follow Arduino/ESP32 conventions
-- Handle errors appropriately
-- Include Serial debugging at 115200 baud
-- Never use emojis
-- Keep code modular and organized"""
+        project_path = self._project_path(context)
+        result.project_path = project_path
+
+        files = {project_path / name: code for name, code in result.code_files.items() if name not in written}
+        if result.platformio_ini:
+            files[project_path / "platformio.ini"] = result.platformio_ini
+
+        # Create each distinct directory once in a single thread hop, then write all files concurrently
+        await asyncio.to_thread(_make_dirs, {project_path, *(path.parent for path in files)})
+        await asyncio.gather(*(
+            asyncio.to_thread(_write_file, path, code_content)
+            for path, code_content in files.items()
+        ))
+
+        return project_path
 
     def _build_generation_prompt(self, context: BuildContext) -> str:
-        prompt = f"""Generate a complete ESP32 project with the following specifications:
+        features = "\n".join(f"- {f}" for f in context.features) or "- Basic functionality"
+
+        parts = [f"""Generate a complete ESP32 project with the following specifications:
 
 Project Name: {context.project_name}
 Board Type: {context.board_type}
 Description: {context.description}
 
 Features requested:
-{chr(10).join(f'- {f}' for f in context.features) if context.features else '- Basic functionality'}
+{features}
 
-"""
+"""]
 
         if context.board_context:
-            prompt += f"\nBoard Context:\n{context.board_context}\n"
+            parts.append(f"\nBoard Context:\n{context.board_context}\n")
 
         if context.libraries:
-            prompt += "\nLibraries to use:\n"
-            for lib in context.libraries:
-                prompt += f"- {lib.get('name', 'N/A')}: {lib.get('description', '')}\n"
+            parts.append("\nLibraries to use:\n")
+            parts.extend(f"- {lib.get('name', 'N/A')}: {lib.get('description', '')}\n" for lib in context.libraries)
 
         if context.materials:
-            prompt += "\nHardware Components:\n"
-            for mat in context.materials:
-                prompt += f"- {mat.get('name', 'N/A')}: {mat.get('description', '')}\n"
+            parts.append("\nHardware Components:\n")
+            parts.extend(f"- {mat.get('name', 'N/A')}: {mat.get('description', '')}\n" for mat in context.materials)
 
         if context.wifi_config:
-            prompt += f"\nWiFi Configuration: SSID will be provided at runtime\n"
+            parts.append("\nWiFi Configuration: SSID will be provided at runtime\n")
 
         if context.custom_code:
-            prompt += f"\nCustom Code Snippet to include:\n{context.custom_code}\n"
+            parts.append(f"\nCustom Code Snippet to include:\n{context.custom_code}\n")
 
-        prompt += """
+        parts.append("""
 Generate:
 1. All necessary source files (main.cpp, headers)
 2. platformio.ini configuration
@@ -648,40 +972,93 @@ Generate:
 5. Error handling and serial debugging
 6. README with build instructions
 
-Respond only with valid JSON."""
+Respond only with valid JSON.""")
 
-        return prompt
+        return "".join(parts)
+
+    def _build_combined_prompt(self, context: BuildContext) -> str:
+        prompt = self._build_generation_prompt(context)
+
+        return prompt + """
+
+Before generating the code, choose the libraries and hardware components the project needs and include them in the same JSON response:
+{
+  "libraries": [
+    {"name": "Library Name", "description": "Brief description", "platformio_name": "library_name"}
+  ],
+  "materials": [
+    {"name": "Component Name", "description": "What it does", "category": "sensor|actuator|communication|power|display|other"}
+  ],
+  "files": {"src/main.cpp": "// code here"},
+  "platformio_ini": "// platformio.ini content",
+  "config": {}
+}"""
 
     def _parse_generation_response(self, content: str) -> Dict[str, Any]:
         """Parse the GLM response"""
-        # Clean up markdown code blocks
-        if "```json" in content:
-            content = content.split("```json")[1].split("```")[0].strip()
-        elif "```" in content:
-            content = content.split("```")[1].split("```")[0].strip()
+        content = _strip_fence(content)
 
-        try:
-            return json.loads(content)
-        except json.JSONDecodeError as e:
-            # Fallback: try to extract JSON from response
+        # Only attempt a full decode when the reply opens like a JSON object
+        if content.startswith("{"):
             try:
-                start = content.find("{")
-                end = content.rfind("}") + 1
-                if start >= 0 and end > start:
-                    return json.loads(content[start:end])
-            except:
+                return orjson.loads(content)
+            except orjson.JSONDecodeError:
                 pass
 
-            print(f"Parse error: {e}")
-            print(f"Content preview: {content[:500]}")
-            return {"files": {}, "platformio_ini": "", "config": {}}
+        # Fallback: try to extract JSON from response
+        start = content.find("{")
+        end = content.rfind("}") + 1
+        if start >= 0 and end > start:
+            try:
+                return orjson.loads(content[start:end])
+            except orjson.JSONDecodeError:
+                pass
+
+        print("Parse error: no valid JSON object in response")
+        print(f"Content preview: {content[:500]}")
+        return {"files": {}, "platformio_ini": "", "config": {}}
+
+
+# Source tokens the simulator looks for, mapped to the feature they indicate
+_CODE_FEATURES = {
+    "wifi": ("WiFi", "WIFI"),
+    "softap": ("softAP",),
+    "web": ("WebServer", "server.begin", "HTTPServer"),
+}
+# One alternation with a named group per feature, so a match reports its feature directly.
+# All tokens are ASCII, so the file is scanned as raw bytes without decoding.
+_CODE_SCANNER = re.compile("|".join(
+    f"(?P<{feature}>{'|'.join(map(re.escape, tokens))})" for feature, tokens in _CODE_FEATURES.items()
+).encode("ascii"))
+_ALL_FEATURES = frozenset(_CODE_FEATURES)
+# Carried between chunks so tokens split across a chunk boundary are still found
+_TOKEN_OVERLAP = max(len(token) for tokens in _CODE_FEATURES.values() for token in tokens) - 1
+SCAN_CHUNK_SIZE = 64 * 1024
+MAX_SIMULATIONS = 256
+
+
+async def _scan_features(path: Path) -> Set[str]:
+    """Collect the features used by a source file, stopping once all of them are seen"""
+    features: Set[str] = set()
+    tail = b""
+
+    async with aiofiles.open(path, "rb") as f:
+        while chunk := await f.read(SCAN_CHUNK_SIZE):
+            text = tail + chunk
+            for match in _CODE_SCANNER.finditer(text):
+                features.add(match.lastgroup)
+                if features >= _ALL_FEATURES:
+                    return features
+            tail = text[-_TOKEN_OVERLAP:]
+
+    return features
 
 
 class ESP32Simulator:
     """WACWI-like ESP32 simulator for testing"""
 
     def __init__(self):
-        self.active_simulations: Dict[str, Any] = {}
+        self.active_simulations: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
 
     async def simulate_project(self, project_path: Path, board_type: str = "esp32") -> Dict[str, Any]:
         """Simulate an ESP32 project without actual hardware"""
@@ -695,29 +1072,33 @@ class ESP32Simulator:
             "ap_ssid": None,
             "web_server": False,
             "logs": [],
-            "started_at": datetime.now().isoformat(),
+            "started_at": _now_iso(),
         }
 
+        # Keep the most recent simulations, evicting the least recently used
+        self.active_simulations.pop(project_name, None)
+        if len(self.active_simulations) >= MAX_SIMULATIONS:
+            self.active_simulations.popitem(last=False)
         self.active_simulations[project_name] = simulation
 
         # Read and analyze main.cpp
         main_cpp = project_path / "src" / "main.cpp"
 
         if main_cpp.exists():
-            code = main_cpp.read_text()
+            features = await _scan_features(main_cpp)
 
             # Check for WiFi
-            if "WiFi" in code or "WIFI" in code:
+            if "wifi" in features:
                 simulation["has_wifi"] = True
                 simulation["ip_address"] = "192.168.1.100"  # Simulated IP
 
             # Check for AP mode
-            if "WiFi.softAP" in code or "softAP" in code:
+            if "softap" in features:
                 simulation["ap_ssid"] = f"{project_name}_AP"
                 simulation["ip_address"] = "192.168.4.1"
 
             # Check for web server
-            if "WebServer" in code or "server.begin" in code or "HTTPServer" in code:
+            if "web" in features:
                 simulation["web_server"] = True
 
             simulation["status"] = "running"
@@ -737,7 +1118,10 @@ class ESP32Simulator:
 
     def get_simulation(self, project_name: str) -> Optional[Dict[str, Any]]:
         """Get simulation status"""
-        return self.active_simulations.get(project_name)
+        simulation = self.active_simulations.get(project_name)
+        if simulation is not None:
+            self.active_simulations.move_to_end(project_name)
+        return simulation
 
     def stop_simulation(self, project_name: str) -> bool:
         """Stop a simulation"""
@@ -1,6 +1,12 @@
+import asyncio
+import orjson
 import httpx
-from typing import Optional, Dict, Any, List
-from config import settings
+from typing import AsyncIterator, Optional, Dict, Any, List
+from config import get_settings
+
+# Pool sizing is generous; the semaphore below is what bounds in-flight requests
+POOL_MAX_CONNECTIONS = 1000
+POOL_MAX_KEEPALIVE = 200
 
 
 class GLMClient:
@@ -11,18 +17,31 @@ class GLMClient:
         api_key: Optional[str] = None,
         base_url: Optional[str] = None,
         model: Optional[str] = None,
+        max_concurrency: Optional[int] = None,
     ):
+        settings = get_settings()
         self.api_key = api_key or settings.glm_api_key
         self.base_url = base_url or settings.glm_api_base
         self.model = model or settings.glm_model
+        self.max_concurrency = max_concurrency or settings.glm_max_concurrency
+
+        # Cap in-flight requests so concurrent builds stay under the provider's rate limit
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
 
+        # HTTP/2 multiplexes concurrent requests over one kept-alive TLS connection
         self.client = httpx.AsyncClient(
             base_url=self.base_url,
             headers={
                 "Authorization": f"Bearer {self.api_key}",
                 "Content-Type": "application/json",
             },
-            timeout=120.0,
+            http2=True,
+            timeout=httpx.Timeout(120.0, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                keepalive_expiry=60.0,
+            ),
         )
 
     async def chat_completion(
@@ -45,13 +64,56 @@ class GLMClient:
 
         payload.update(kwargs)
 
-        response = await self.client.post(
-            "/chat/completions",
-            json=payload,
-        )
+        async with self._semaphore:
+            response = await self.client.post(
+                "/chat/completions",
+                content=orjson.dumps(payload),
+            )
 
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
+
+    async def stream_chat_completion(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+        **kwargs
+    ) -> AsyncIterator[str]:
+        """Create chat completion, yielding content deltas as they arrive"""
+
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "stream": True,
+        }
+
+        if max_tokens:
+            payload["max_tokens"] = max_tokens
+
+        payload.update(kwargs)
+
+        async with self._semaphore, self.client.stream("POST", "/chat/completions", content=orjson.dumps(payload)) as response:
+            response.raise_for_status()
+
+            # Providers that ignore "stream" answer with a single JSON body
+            if not response.headers.get("content-type", "").startswith("text/event-stream"):
+                body = orjson.loads(await response.aread())
+                yield body["choices"][0]["message"]["content"]
+                return
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+
+                delta = orjson.loads(data)["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
 
     async def close(self):
         """Close the HTTP client"""
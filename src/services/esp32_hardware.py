@@ -1,11 +1,93 @@
 import asyncio
+import os
+import re
+import signal
+import shutil
+from collections import deque
+from contextlib import asynccontextmanager
 import serial
 import serial.tools.list_ports
-from typing import Optional, Dict, Any, List
+from typing import AsyncIterator, Deque, Optional, Dict, Any, List, Tuple
 from pathlib import Path
 import time
 
-from config import settings
+from config import get_settings
+
+# Only the tail of upload tool output is kept for the result
+OUTPUT_TAIL_LINES = 200
+
+# A blocking read waits at most this long per call, returns once a burst goes quiet for
+# SERIAL_INTER_BYTE_TIMEOUT, and takes up to SERIAL_READ_SIZE bytes in one syscall
+SERIAL_POLL_TIMEOUT = 0.25
+SERIAL_INTER_BYTE_TIMEOUT = 0.01
+SERIAL_READ_SIZE = 8192
+
+# Port enumeration walks the OS device tree, so results are reused briefly
+PORTS_CACHE_TTL = 1.0
+
+# (VID, PID) pairs of USB-serial bridges found on ESP32 boards; a PID of None matches any product
+_ESP32_USB_IDS = frozenset({
+    (0x10C4, None),  # Silicon Labs CP210x
+    (0x1A86, None),  # WCH CH340/CH9102
+    (0x0403, None),  # FTDI
+    (0x303A, None),  # Espressif native USB
+})
+_ESP32_DESC_TOKENS = ("ch340", "cp210", "ft232", "usb serial", "uart")
+
+# Test result markers in serial output. Only letters and digits count as word neighbours, so
+# TEST_PASS and ALL_TESTS_PASSED match while BOOK and TOKEN don't
+_PASS_RE = re.compile(r"(?<![^\W_])(?:PASS(?:ED)?|OK)(?![^\W_])", re.IGNORECASE)
+_FAIL_RE = re.compile(r"(?<![^\W_])(?:FAIL(?:ED|URE)?|ERRORS?)(?![^\W_])", re.IGNORECASE)
+
+
+async def _collect_lines(stream: asyncio.StreamReader, tail: Deque[str], callback=None):
+    """Consume a process pipe line by line, keeping only the most recent lines"""
+    async for raw in stream:
+        line = raw.decode("utf-8", errors="replace").rstrip()
+        tail.append(line)
+        if line and callback:
+            await callback(line)
+
+
+async def _run_command(cmd: List[str], timeout: float, cwd: Optional[str] = None, progress_callback=None) -> Tuple[int, str, str]:
+    """Run a command without blocking the event loop, streaming stdout to progress_callback"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        # Own process group, so an aborted run also kills helpers (scons, esptool) holding our pipes
+        start_new_session=True,
+    )
+
+    stdout: Deque[str] = deque(maxlen=OUTPUT_TAIL_LINES)
+    stderr: Deque[str] = deque(maxlen=OUTPUT_TAIL_LINES)
+
+    readers = asyncio.gather(
+        _collect_lines(proc.stdout, stdout, progress_callback),
+        _collect_lines(proc.stderr, stderr),
+        proc.wait(),
+    )
+    try:
+        await asyncio.wait_for(readers, timeout)
+    except BaseException:
+        # Timeout, a failing progress_callback, an overlong line or cancellation: nobody will read
+        # the pipes any more, so don't leave the tool (still flashing, perhaps) running behind us
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except AttributeError:
+            # No process groups on this platform
+            if proc.returncode is None:
+                proc.kill()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        # Stop the remaining readers and collect their outcome so nothing is left pending
+        readers.cancel()
+        await asyncio.gather(readers, return_exceptions=True)
+        raise
+
+    return proc.returncode, "\n".join(stdout), "\n".join(stderr)
 
 
 class ESP32Hardware:
@@ -14,35 +96,60 @@ class ESP32Hardware:
     def __init__(self):
         self.serial_conn: Optional[serial.Serial] = None
         self.baud_rate = 115200
-        self.timeout = 5
-
-    def list_ports(self) -> List[Dict[str, str]]:
+        self.timeout = SERIAL_POLL_TIMEOUT
+        self._ports_cache: Optional[List[Dict[str, Any]]] = None
+        self._ports_ts = 0.0
+        # Bytes received but not yet split into lines
+        self._rx_buf = bytearray()
+        # Open session() users, and whether the first of them opened the port; only changed under _open_lock
+        self._ref_count = 0
+        self._session_opened = False
+        self._open_lock = asyncio.Lock()
+        # One reader at a time, so concurrent users never split the incoming lines between them
+        self._read_lock = asyncio.Lock()
+
+    def list_ports(self) -> List[Dict[str, Any]]:
         """List available serial ports"""
+        if self._ports_cache is not None and time.monotonic() - self._ports_ts < PORTS_CACHE_TTL:
+            return self._ports_cache
+
         ports = []
         try:
-            for port in serial.tools.list_ports.comports():
+            # Sorted so detection picks the same port every time
+            for port in sorted(serial.tools.list_ports.comports(), key=lambda p: p.device):
                 ports.append({
                     "device": port.device,
                     "description": port.description or "",
                     "hwid": port.hwid or "",
-                    "vid": hex(port.vid) if hasattr(port, 'vid') and port.vid else "0000",
-                    "pid": hex(port.pid) if hasattr(port, 'pid') and port.pid else "0000",
+                    "vid": getattr(port, 'vid', None),
+                    "pid": getattr(port, 'pid', None),
                 })
         except Exception as e:
             print(f"Error listing ports: {e}")
+            return ports
+
+        self._ports_cache = ports
+        self._ports_ts = time.monotonic()
         return ports
 
+    def invalidate_ports(self):
+        """Force the next list_ports() call to re-enumerate"""
+        self._ports_cache = None
+
     async def detect_esp32(self) -> Optional[str]:
         """Detect ESP32 connected to USB"""
-        ports = self.list_ports()
-        esp32_vids = ["0x10c4", "0x1a86", "0x0403", "0x303a"]  # Common USB-serial chip VIDs
+        # Enumeration can take tens of milliseconds, so keep it off the event loop
+        ports = await asyncio.to_thread(self.list_ports)
+
+        for port in ports:
+            # Known USB-serial bridge
+            if (port['vid'], None) in _ESP32_USB_IDS or (port['vid'], port['pid']) in _ESP32_USB_IDS:
+                return port['device']
 
         for port in ports:
-            # Check if it's likely an ESP32
+            # Last resort: a description that looks like a USB-serial adapter
             desc_lower = port['description'].lower()
-            if any(vid in port['vid'] for vid in esp32_vids) or \
-               'ch340' in desc_lower or 'cp210' in desc_lower or 'ft232' in desc_lower or \
-               'usb serial' in desc_lower or 'uart' in desc_lower:
+            if any(token in desc_lower for token in _ESP32_DESC_TOKENS):
                 return port['device']
 
         # Fallback: first usb serial port
@@ -65,16 +172,20 @@ class ESP32Hardware:
                 port=port,
                 baudrate=self.baud_rate,
                 timeout=self.timeout,
+                inter_byte_timeout=SERIAL_INTER_BYTE_TIMEOUT,
                 write_timeout=5
             )
+            self._rx_buf.clear()
             # Reset the connection
             self.serial_conn.setDTR(False)
-            time.sleep(0.1)
+            await asyncio.sleep(0.1)
             self.serial_conn.setDTR(True)
-            time.sleep(0.5)
+            await asyncio.sleep(0.5)
             return True
         except Exception as e:
             print(f"Serial connect error: {e}")
+            # The device may have gone away; don't trust the cached port list
+            self.invalidate_ports()
             return False
 
     def disconnect(self):
@@ -85,19 +196,58 @@ class ESP32Hardware:
             except:
                 pass
             self.serial_conn = None
+        self._rx_buf.clear()
+        self.invalidate_ports()
+
+    @asynccontextmanager
+    async def session(self, port: Optional[str] = None) -> AsyncIterator[bool]:
+        """Share one open port between callers; yields whether the port is connected.
+
+        Sharing keeps the port open, but reads are sequential: each reader holds the port
+        until it finishes, and other readers wait for it.
+        """
+        async with self._open_lock:
+            # Only the first user opens (and resets) the board; later ones wait for it, then reuse it
+            if self._ref_count == 0:
+                self._session_opened = self.serial_conn is None
+                if self._session_opened and not await self.connect(port):
+                    connected = False
+                else:
+                    connected = True
+            else:
+                connected = self.serial_conn is not None
+            if connected:
+                self._ref_count += 1
+
+        if not connected:
+            yield False
+            return
 
-    async def upload_firmware(self, firmware_path: Path, port: Optional[str] = None) -> Dict[str, Any]:
+        try:
+            yield True
+        finally:
+            self._ref_count -= 1
+            if self._ref_count == 0 and self._session_opened:
+                self.disconnect()
+
+    async def upload_firmware(self, firmware_path: Path, port: Optional[str] = None, progress_callback=None) -> Dict[str, Any]:
         """Upload firmware to ESP32 using esptool"""
-        import subprocess
+        # Detect the port and locate esptool at the same time
+        port_task = asyncio.create_task(self.detect_esp32()) if port is None else None
+        esptool = await asyncio.to_thread(shutil.which, "esptool.py")
 
-        if port is None:
-            port = await self.detect_esp32()
+        if port_task is not None:
+            port = await port_task
             if port is None:
                 return {"success": False, "error": "No ESP32 detected"}
 
+        if esptool is None:
+            # esptool not installed, try platformio
+            return await self.upload_with_platformio(firmware_path, port, progress_callback)
+
         # Build esptool command
         cmd = [
-            "esptool.py",
+            esptool,
             "--chip", "esp32",
             "--port", port,
             "--baud", "460800",
@@ -106,35 +256,28 @@ class ESP32Hardware:
         ]
 
         try:
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=60
-            )
+            returncode, stdout, stderr = await _run_command(cmd, timeout=60, progress_callback=progress_callback)
 
-            success = result.returncode == 0
+            success = returncode == 0
 
             return {
                 "success": success,
-                "stdout": result.stdout,
-                "stderr": result.stderr,
+                "stdout": stdout,
+                "stderr": stderr,
                 "port": port,
-                "error": None if success else result.stderr
+                "error": None if success else stderr
             }
 
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
             return {"success": False, "error": "Upload timeout"}
         except FileNotFoundError:
             # esptool not installed, try platformio
-            return await self.upload_with_platformio(firmware_path, port)
+            return await self.upload_with_platformio(firmware_path, port, progress_callback)
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    async def upload_with_platformio(self, firmware_path: Path, port: str) -> Dict[str, Any]:
+    async def upload_with_platformio(self, firmware_path: Path, port: str, progress_callback=None) -> Dict[str, Any]:
         """Fallback: Upload using platformio"""
-        import subprocess
-
         cmd = [
             "platformio", "run",
             "--target", "upload",
@@ -145,25 +288,47 @@ class ESP32Hardware:
         project_dir = firmware_path.parent.parent
 
         try:
-            result = subprocess.run(
-                cmd,
-                cwd=str(project_dir),
-                capture_output=True,
-                text=True,
-                timeout=120
-            )
+            returncode, stdout, stderr = await _run_command(cmd, timeout=120, cwd=str(project_dir), progress_callback=progress_callback)
 
             return {
-                "success": result.returncode == 0,
-                "stdout": result.stdout,
-                "stderr": result.stderr,
+                "success": returncode == 0,
+                "stdout": stdout,
+                "stderr": stderr,
                 "port": port,
-                "error": result.stderr if result.returncode != 0 else None
+                "error": stderr if returncode != 0 else None
             }
 
         except Exception as e:
             return {"success": False, "error": str(e)}
 
+    def _set_read_timeout(self, timeout: float):
+        # Changing the timeout reconfigures the port, so only do it when the value differs
+        timeout = min(timeout, SERIAL_POLL_TIMEOUT)
+        if self.serial_conn.timeout != timeout:
+            self.serial_conn.timeout = timeout
+
+    def _read_available(self, timeout: float) -> bytes:
+        """Block until a burst of data arrives or timeout passes (runs in a worker thread)"""
+        self._set_read_timeout(timeout)
+        return self.serial_conn.read(SERIAL_READ_SIZE)
+
+    def _read_up_to(self, size: int, timeout: float) -> bytes:
+        """Block until size bytes arrive or timeout passes (runs in a worker thread)"""
+        self._set_read_timeout(timeout)
+        return self.serial_conn.read(size)
+
+    def _drain_lines(self) -> List[str]:
+        """Split every complete line off the receive buffer, leaving any partial line in place"""
+        lines = []
+        start = 0
+        while (end := self._rx_buf.find(b"\n", start)) >= 0:
+            line = self._rx_buf[start:end].decode('utf-8', errors='ignore').strip()
+            if line:
+                lines.append(line)
+            start = end + 1
+        del self._rx_buf[:start]
+        return lines
+
     async def read_serial(self, duration: float = 5.0) -> List[str]:
         """Read from serial for specified duration"""
         if not self.serial_conn:
@@ -171,20 +336,65 @@ class ESP32Hardware:
                 return []
 
         lines = []
-        start_time = time.time()
 
-        while time.time() - start_time < duration:
-            try:
-                if self.serial_conn.in_waiting > 0:
-                    line = self.serial_conn.readline().decode('utf-8', errors='ignore').strip()
-                    if line:
-                        lines.append(line)
-            except:
-                break
-            await asyncio.sleep(0.1)
+        async with self._read_lock:
+            deadline = time.monotonic() + duration
+
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    self._rx_buf += await asyncio.to_thread(self._read_available, remaining)
+                except (serial.SerialException, OSError):
+                    break
+                lines.extend(self._drain_lines())
+
+            # Whatever is left is a line the device never terminated
+            line = self._rx_buf.decode('utf-8', errors='ignore').strip()
+            self._rx_buf.clear()
+        if line:
+            lines.append(line)
 
         return lines
 
+    async def read_raw(self, duration: float = 5.0) -> bytes:
+        """Read raw bytes from serial for specified duration"""
+        if not self.serial_conn:
+            if not await self.connect():
+                return b""
+
+        async with self._read_lock:
+            deadline = time.monotonic() + duration
+
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    self._rx_buf += await asyncio.to_thread(self._read_available, remaining)
+                except (serial.SerialException, OSError):
+                    break
+
+            # One copy out of the receive buffer instead of concatenating chunks
+            data = bytes(self._rx_buf)
+            self._rx_buf.clear()
+        return data
+
+    async def read_exactly(self, n: int, timeout: float) -> bytes:
+        """Read exactly n bytes from serial, returning early with fewer only if the timeout expires"""
+        if not self.serial_conn:
+            if not await self.connect():
+                return b""
+
+        async with self._read_lock:
+            # Bytes already received by a line reader come first
+            buf = self._rx_buf[:n]
+            del self._rx_buf[:n]
+
+            deadline = time.monotonic() + timeout
+            while len(buf) < n and (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    buf += await asyncio.to_thread(self._read_up_to, n - len(buf), remaining)
+                except (serial.SerialException, OSError):
+                    break
+
+        return bytes(buf)
+
     async def run_test(self, test_code: str, timeout: float = 30.0) -> Dict[str, Any]:
         """Upload and run test code on ESP32"""
         # This would create a test sketch, upload it, and monitor output
@@ -195,59 +405,57 @@ class ESP32Hardware:
             "error": None
         }
 
-        # Connect to serial
-        if not await self.connect():
-            results["error"] = "Could not connect to ESP32"
-            return results
+        async with self.session() as connected:
+            if not connected:
+                results["error"] = "Could not connect to ESP32"
+                return results
 
-        try:
-            # Read serial output for test results
-            output = await self.read_serial(timeout)
-
-            results["output"] = output
-            results["success"] = True
-
-            # Analyze output for test results
-            for line in output:
-                if "PASS" in line.upper() or "OK" in line.upper():
-                    results["test_passed"] = True
-                elif "FAIL" in line.upper() or "ERROR" in line.upper():
-                    results["test_passed"] = False
-                    break
+            try:
+                # Read serial output for test results
+                output = await self.read_serial(timeout)
 
-        except Exception as e:
-            results["error"] = str(e)
+                results["output"] = output
+                results["success"] = True
 
-        finally:
-            self.disconnect()
+                # Analyze output for test results; a pass marker takes precedence within a line,
+                # so "PASS: 3, 0 errors" still passes
+                for line in output:
+                    if _PASS_RE.search(line):
+                        results["test_passed"] = True
+                    elif _FAIL_RE.search(line):
+                        results["test_passed"] = False
+                        break
+
+            except Exception as e:
+                results["error"] = str(e)
 
         return results
 
     async def monitor_serial(self, callback=None, duration: float = 60.0):
         """Monitor serial output and call callback for each line"""
-        if not await self.connect():
-            return
-
-        try:
-            start_time = time.time()
-            while time.time() - start_time < duration:
-                if self.serial_conn and self.serial_conn.in_waiting > 0:
-                    line = self.serial_conn.readline().decode('utf-8', errors='ignore').strip()
-                    if line and callback:
-                        await callback(line)
-                await asyncio.sleep(0.05)
-
-        finally:
-            self.disconnect()
-
-    def get_status(self) -> Dict[str, Any]:
-        """Get current hardware status"""
-        return {
+        async with self.session() as connected:
+            if not connected:
+                return
+
+            async with self._read_lock:
+                deadline = time.monotonic() + duration
+                while self.serial_conn and (remaining := deadline - time.monotonic()) > 0:
+                    self._rx_buf += await asyncio.to_thread(self._read_available, remaining)
+
+                    for line in self._drain_lines():
+                        if callback:
+                            await callback(line)
+
+    def get_status(self, include_ports: bool = False) -> Dict[str, Any]:
+        """Get current hardware status, enumerating serial ports only when asked"""
+        status = {
             "connected": self.serial_conn is not None,
             "port": self.serial_conn.port if self.serial_conn else None,
             "baud_rate": self.baud_rate if self.serial_conn else None,
-            "available_ports": self.list_ports()
         }
+        if include_ports:
+            status["available_ports"] = self.list_ports()
+        return status
 
 
 # Global hardware instance
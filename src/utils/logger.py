@@ -1,9 +1,14 @@
 import logging
+import logging.handlers
 import sys
 from pathlib import Path
-from datetime import datetime
 from typing import Optional
 
+# Records never use caller, thread or process details, so skip collecting them
+logging._srcfile = None
+logging.logThreads = False
+logging.logProcesses = False
+
 
 class Logger:
     """Simple logger for PoofMicro"""
@@ -25,31 +30,42 @@ class Logger:
         # File handler if log_dir provided
         if log_dir:
             log_dir.mkdir(parents=True, exist_ok=True)
-            log_file = log_dir / f"poofmicro_{datetime.now().strftime('%Y%m%d')}.log"
 
-            file_handler = logging.FileHandler(log_file)
+            # Roll over at midnight and keep a week of history
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                log_dir / "poofmicro.log", when="midnight", backupCount=7
+            )
             file_handler.setLevel(logging.DEBUG)
             file_formatter = logging.Formatter(
-                "%(asctime)s - %(name)s - %(levelname)s - %(funcName)s:%(lineno)d - %(message)s",
+                "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
                 datefmt="%Y-%m-%d %H:%M:%S"
             )
             file_handler.setFormatter(file_formatter)
-            self.logger.addHandler(file_handler)
 
-    def info(self, message: str):
-        self.logger.info(message)
+            # Batch records in memory; flush every 256 records or straight away on errors
+            self.logger.addHandler(logging.handlers.MemoryHandler(
+                capacity=256, flushLevel=logging.ERROR, target=file_handler
+            ))
+
+    @property
+    def debug_enabled(self) -> bool:
+        """Whether debug records would be emitted; check before building expensive messages"""
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def info(self, message: str, *args):
+        self.logger.info(message, *args)
 
-    def debug(self, message: str):
-        self.logger.debug(message)
+    def debug(self, message: str, *args):
+        self.logger.debug(message, *args)
 
-    def warning(self, message: str):
-        self.logger.warning(message)
+    def warning(self, message: str, *args):
+        self.logger.warning(message, *args)
 
-    def error(self, message: str):
-        self.logger.error(message)
+    def error(self, message: str, *args):
+        self.logger.error(message, *args)
 
-    def critical(self, message: str):
-        self.logger.critical(message)
+    def critical(self, message: str, *args):
+        self.logger.critical(message, *args)
 
 
 logger = Logger()
@@ -1,7 +1,29 @@
+import os
 import re
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 
+# Alphanumeric, spaces, hyphens, underscores only
+_PROJECT_NAME_RE = re.compile(r'^[a-zA-Z0-9_\- ]+$')
+# Basic format check for GLM API keys
+_API_KEY_RE = re.compile(r'^[a-z0-9]+\.[A-Za-z0-9]+$')
+
+# Accepted board spellings mapped to their canonical name
+_BOARD_ALIASES = {
+    "esp32": "esp32",
+    "esp32s2": "esp32s2",
+    "esp32-s2": "esp32s2",
+    "esp32s3": "esp32s3",
+    "esp32-s3": "esp32s3",
+    "esp32c3": "esp32c3",
+    "esp32-c3": "esp32c3",
+    "esp32c6": "esp32c6",
+    "esp32-c6": "esp32c6",
+}
+VALID_BOARDS = frozenset(_BOARD_ALIASES.values())
+_BOARD_ERROR = f"Invalid board type. Must be one of: {', '.join(sorted(VALID_BOARDS))}"
+
 
 class ValidationError(Exception):
     """Custom validation error"""
@@ -16,8 +38,7 @@ def validate_project_name(name: str) -> str:
     if len(name) > 100:
         raise ValidationError("Project name too long (max 100 characters)")
 
-    # Alphanumeric, spaces, hyphens, underscores only
-    if not re.match(r'^[a-zA-Z0-9_\- ]+$', name):
+    if not _PROJECT_NAME_RE.match(name):
         raise ValidationError("Project name contains invalid characters")
 
     return name.strip()
@@ -25,24 +46,12 @@ def validate_project_name(name: str) -> str:
 
 def validate_esp32_board(board: str) -> str:
     """Validate ESP32 board type"""
-    valid_boards = [
-        "esp32",
-        "esp32s2",
-        "esp32s3",
-        "esp32c3",
-        "esp32c6",
-        "esp32-c3",
-        "esp32-c6",
-        "esp32-s2",
-        "esp32-s3",
-    ]
-
-    board = board.lower().strip()
+    canonical = _BOARD_ALIASES.get(board.lower().strip())
 
-    if board not in valid_boards:
-        raise ValidationError(f"Invalid board type. Must be one of: {', '.join(valid_boards)}")
+    if canonical is None:
+        raise ValidationError(_BOARD_ERROR)
 
-    return board
+    return canonical
 
 
 def validate_api_key(api_key: str) -> str:
@@ -52,17 +61,25 @@ def validate_api_key(api_key: str) -> str:
 
     api_key = api_key.strip()
 
-    # Basic format check for GLM API keys
-    if not re.match(r'^[a-z0-9]+\.[A-Za-z0-9]+$', api_key):
+    if not _API_KEY_RE.match(api_key):
         raise ValidationError("Invalid API key format")
 
     return api_key
 
 
+@lru_cache(maxsize=512)
+def _resolve_absolute(path: str) -> Path:
+    return Path(path).resolve()
+
+
 def validate_file_path(path: str, must_exist: bool = False) -> Path:
     """Validate file path"""
     try:
-        path_obj = Path(path).resolve()
+        # Absolute paths resolve the same regardless of cwd, so their resolution can be reused
+        if not must_exist and os.path.isabs(path):
+            path_obj = _resolve_absolute(path)
+        else:
+            path_obj = Path(path).resolve()
 
         if must_exist and not path_obj.exists():
             raise ValidationError(f"File does not exist: {path}")